@@ -0,0 +1,378 @@
+# --------------------------------------------------------------
+#  a2a_core.py  (Azure AI Studio client shared by the A2A entrypoints)
+# --------------------------------------------------------------
+import asyncio
+import contextlib
+import os
+import random
+import time
+import logging
+import weakref
+from azure.core.credentials import AccessToken
+from azure.identity.aio import DefaultAzureCredential, ManagedIdentityCredential
+import aiohttp
+import orjson
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------
+# 1. Azure AI Studio configuration
+# ------------------------------------------------------------------
+PROJECT_NAME = "agent-to-agent-5055"
+AI_SERVICE_NAME = "agent-to-agent-5055-resource"
+ASSISTANT_ID = "asst_zQ8ANX9CJfElxVlHKEKiLa5P"
+API_VERSION = "2025-05-01"
+BASE_URL = f"https://{AI_SERVICE_NAME}.services.ai.azure.com/api/projects/{PROJECT_NAME}"
+
+TOKEN_SCOPE = "https://ai.azure.com"
+# The credential chain is only walked again when the cached token is within
+# TOKEN_REFRESH_MARGIN seconds of expiry.
+TOKEN_REFRESH_MARGIN = 300
+
+# Max concurrent outbound Azure AI requests per worker; excess callers queue
+# instead of tripping subscription / IMDS throttling under load. Every call
+# goes to one host, so the connector's per-host limit is sized to match and
+# this semaphore is the only bound that actually applies.
+# Clamped to 1: a zero-slot semaphore never admits a caller.
+MAX_INFLIGHT = max(1, int(os.getenv("AZURE_AI_MAX_INFLIGHT", "64")))
+
+# Transient-failure retry policy. Only idempotent calls are replayed – a
+# retried POST could create a second thread/run.
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.2
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_METHODS = {"GET", "DELETE"}
+
+# Run-status polling: exponential backoff with ~10% jitter, so short runs
+# are picked up quickly and long runs don't hammer the service.
+POLL_INITIAL_DELAY = 0.2
+POLL_MAX_DELAY = 2.0
+POLL_MULTIPLIER = 1.6
+# Upper bound on any server-supplied Retry-After we are willing to sleep
+RETRY_AFTER_MAX = POLL_MAX_DELAY * 5
+
+# Streamed runs (Server-Sent Events): one long-lived response carries the
+# whole run, so no status polling or final messages GET is needed.
+RUN_FAILED_EVENTS = {"thread.run.failed", "thread.run.cancelled", "thread.run.expired",
+                     "thread.run.incomplete"}
+
+# Capital questions are idempotent and low-cardinality: cache normalized
+# user text → reply. Only first turns of a context are context-free, so only
+# those read or fill the cache.
+REPLY_CACHE_SIZE = 2048
+REPLY_CACHE_TTL = 3600
+
+# One Azure thread per A2A context, so follow-up turns skip thread creation
+# and keep conversation history.
+THREAD_CACHE_SIZE = 10_000
+THREAD_CACHE_TTL = 3600
+
+
+# ------------------------------------------------------------------
+# 2. Helpers
+# ------------------------------------------------------------------
+def _poll_delay(delay: float, retry_after: str | None) -> float:
+    """Next sleep: the server's (clamped) Retry-After when given, else delay + jitter."""
+    if retry_after:
+        try:
+            server_delay = float(retry_after)
+        except ValueError:
+            server_delay = -1.0
+        if server_delay >= 0:
+            return min(server_delay, RETRY_AFTER_MAX)
+    return delay + random.uniform(0, delay * 0.1)
+
+
+def _make_credential():
+    """
+    Inside Azure (App Service / Functions set WEBSITE_INSTANCE_ID) only the
+    managed identity is reachable, so skip DefaultAzureCredential's chain.
+    AZURE_CLIENT_ID selects a user-assigned identity, as it does for the chain.
+    """
+    if os.getenv("WEBSITE_INSTANCE_ID"):
+        return ManagedIdentityCredential(client_id=os.getenv("AZURE_CLIENT_ID"))
+    return DefaultAzureCredential()
+
+
+class ThreadCache(TTLCache):
+    """contextId → Azure thread_id; evicted entries are kept for deletion."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__(maxsize, ttl)
+        self.evicted: list[tuple[str, str]] = []
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        self.evicted.extend(expired)
+        return expired
+
+    def popitem(self):
+        item = super().popitem()
+        self.evicted.append(item)
+        return item
+
+
+# ------------------------------------------------------------------
+# 3. Azure AI client
+# ------------------------------------------------------------------
+class AzureAIClient:
+    """
+    Per-process Azure AI Studio agents client: pooled aiohttp session,
+    cached bearer token, reply cache and contextId → thread mapping.
+    Caches are only touched from the event loop; turns of one context are
+    serialized by a per-context lock.
+    """
+
+    def __init__(self, base_url: str = BASE_URL, assistant_id: str = ASSISTANT_ID,
+                 api_version: str = API_VERSION):
+        self.assistant_id = assistant_id
+
+        # URL templates – fill with .format(tid=..., rid=...)
+        self.thread_runs_url = f"{base_url}/threads/runs?api-version={api_version}"
+        self.thread_url = base_url + "/threads/{tid}?api-version=" + api_version
+        self.runs_url = base_url + "/threads/{tid}/runs?api-version=" + api_version
+        self.run_url = base_url + "/threads/{tid}/runs/{rid}?api-version=" + api_version
+        self.messages_url = base_url + "/threads/{tid}/messages?api-version=" + api_version
+        self.latest_message_url = self.messages_url + "&order=desc&limit=1"
+
+        self._cred = _make_credential()
+        self._token: AccessToken | None = None
+        self._token_lock = asyncio.Lock()
+        # Outbound headers are rebuilt only when the token is refreshed
+        self._auth_headers: dict = {}
+        # Created lazily – aiohttp sessions must be built inside a running loop
+        self._session: aiohttp.ClientSession | None = None
+        self._outbound_sem = asyncio.Semaphore(MAX_INFLIGHT)
+        # Callers currently queued on the outbound semaphore (saturation metric)
+        self.outbound_waiters = 0
+
+        self.replies: TTLCache = TTLCache(maxsize=REPLY_CACHE_SIZE, ttl=REPLY_CACHE_TTL)
+        self.threads = ThreadCache(maxsize=THREAD_CACHE_SIZE, ttl=THREAD_CACHE_TTL)
+        # contextId → turns answered from the reply cache before the context
+        # had a thread; replayed into the thread when it is created
+        self.cached_turns: TTLCache = TTLCache(maxsize=THREAD_CACHE_SIZE, ttl=THREAD_CACHE_TTL)
+        self._background: set[asyncio.Task] = set()
+        # contextId → lock; entries vanish once no turn holds or awaits them
+        self._context_locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+    # ---------------------------- transport ----------------------------
+    def _token_stale(self) -> bool:
+        return self._token is None or self._token.expires_on - time.time() < TOKEN_REFRESH_MARGIN
+
+    async def get_token(self) -> str:
+        if self._token_stale():
+            async with self._token_lock:
+                if self._token_stale():
+                    self._token = await self._cred.get_token(TOKEN_SCOPE)
+                    self._auth_headers = {
+                        "Authorization": f"Bearer {self._token.token}",
+                        "Content-Type": "application/json"
+                    }
+        return self._token.token
+
+    async def _headers(self) -> dict:
+        """Shared, read-only header dict for the current token (aiohttp copies it)."""
+        await self.get_token()
+        return self._auth_headers
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=max(100, MAX_INFLIGHT), limit_per_host=MAX_INFLIGHT,
+                                               ttl_dns_cache=300)
+            )
+        return self._session
+
+    @contextlib.asynccontextmanager
+    async def _outbound(self):
+        """Hold one of the MAX_INFLIGHT outbound request slots."""
+        if self._outbound_sem.locked():
+            logger.debug("Azure AI outbound limit reached, %d waiting", self.outbound_waiters + 1)
+        self.outbound_waiters += 1
+        try:
+            await self._outbound_sem.acquire()
+        finally:
+            self.outbound_waiters -= 1
+        try:
+            yield
+        finally:
+            self._outbound_sem.release()
+
+    async def request(self, method: str, url: str, json_body: dict | None = None):
+        """Send one Azure AI call; returns (json body, response headers)."""
+        headers = await self._headers()
+        attempt = 0
+        while True:
+            data = orjson.dumps(json_body) if json_body is not None else None
+            async with self._outbound(), \
+                    self.get_session().request(method, url, headers=headers, data=data) as resp:
+                if not (resp.status in RETRY_STATUSES and method in RETRY_METHODS and attempt < RETRY_TOTAL):
+                    resp.raise_for_status()
+                    return await resp.json(loads=orjson.loads), resp.headers
+                retry_after = resp.headers.get("Retry-After", "")
+            attempt += 1
+            delay = RETRY_BACKOFF * 2 ** (attempt - 1)
+            if retry_after.isdigit():
+                delay = max(delay, min(int(retry_after), RETRY_AFTER_MAX))
+            await asyncio.sleep(delay)
+
+    async def call_api(self, method: str, url: str, json_body: dict | None = None):
+        body, _ = await self.request(method, url, json_body)
+        return body
+
+    async def stream_run(self, url: str, json_body: dict):
+        """
+        POST a run with stream=true and collect the assistant's reply.
+        Returns (last run object, reply text); the text is None if the stream
+        ended before the run completed, so the caller can fall back to polling.
+        """
+        headers = {**await self._headers(), "Accept": "text/event-stream"}
+        run, chunks, event = None, [], ""
+        data = orjson.dumps({**json_body, "stream": True})
+        async with self._outbound(), self.get_session().post(url, headers=headers, data=data) as resp:
+            resp.raise_for_status()
+            async for raw_line in resp.content:
+                line = raw_line.decode("utf-8").rstrip("\r\n")
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                    continue
+                if not line.startswith("data:"):
+                    continue
+                frame = line[5:].strip()
+                if event == "done" or frame == "[DONE]":
+                    break
+                if event == "error":
+                    raise RuntimeError(f"Run stream error: {frame}")
+                # thread.run.step.* frames carry run-step objects, not the run
+                if event.startswith("thread.run.") and not event.startswith("thread.run.step."):
+                    run = orjson.loads(frame)
+                    if event == "thread.run.completed":
+                        return run, "".join(chunks)
+                    if event in RUN_FAILED_EVENTS:
+                        raise RuntimeError(f"Run {run['status']}")
+                elif event == "thread.message.delta":
+                    for content in orjson.loads(frame)["delta"].get("content", []):
+                        if content.get("type") == "text":
+                            chunks.append(content["text"].get("value", ""))
+        return run, None
+
+    # ---------------------------- agents API ----------------------------
+    async def create_thread_and_run(self, user_text: str, history: list[dict] = ()):
+        """Create thread (+ prior messages) + message + run in a single streamed round trip."""
+        return await self.stream_run(self.thread_runs_url, {
+            "assistant_id": self.assistant_id,
+            "thread": {"messages": [*history, {"role": "user", "content": user_text}]}
+        })
+
+    async def post_message(self, thread_id: str, user_text: str):
+        await self.call_api("POST", self.messages_url.format(tid=thread_id),
+                            {"role": "user", "content": user_text})
+
+    async def run(self, thread_id: str):
+        return await self.stream_run(self.runs_url.format(tid=thread_id),
+                                     {"assistant_id": self.assistant_id})
+
+    async def wait_complete(self, thread_id: str, run_id: str):
+        delay = POLL_INITIAL_DELAY
+        while True:
+            status_resp, status_headers = await self.request(
+                "GET", self.run_url.format(tid=thread_id, rid=run_id))
+            status = status_resp["status"]
+            if status == "completed": break
+            if status in ["failed", "cancelled", "expired", "incomplete"]:
+                raise RuntimeError(f"Run {status}")
+            await asyncio.sleep(_poll_delay(delay, status_headers.get("Retry-After")))
+            delay = min(delay * POLL_MULTIPLIER, POLL_MAX_DELAY)
+
+    async def latest_assistant_message(self, thread_id: str) -> str:
+        try:
+            messages = await self.call_api("GET", self.latest_message_url.format(tid=thread_id))
+        except aiohttp.ClientResponseError as e:
+            if e.status != 400:
+                raise
+            # order/limit rejected → full list (newest first by default)
+            messages = await self.call_api("GET", self.messages_url.format(tid=thread_id))
+        reply_msg = next((m for m in messages["data"] if m["role"] == "assistant"), None)
+        return reply_msg["content"][0]["text"]["value"] if reply_msg else "No reply"
+
+    async def delete_threads(self, evicted: list[tuple[str, str]]):
+        for context_id, thread_id in evicted:
+            # Eviction does not mean the thread is dead: its context may have
+            # re-stored it (the cache expires before every insert) or have a
+            # turn in flight that will store it again when it finishes
+            if context_id in self._context_locks or thread_id in self.threads.values():
+                continue
+            try:
+                await self.call_api("DELETE", self.thread_url.format(tid=thread_id))
+            except Exception:
+                logger.warning("Failed to delete thread %s", thread_id, exc_info=True)
+
+    def _reap_threads(self):
+        """Delete threads whose context expired, off the request path."""
+        self.threads.expire()
+        if not self.threads.evicted:
+            return
+        evicted, self.threads.evicted = self.threads.evicted, []
+        task = asyncio.create_task(self.delete_threads(evicted))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    # ---------------------------- one chat turn ----------------------------
+    async def chat(self, user_text: str, context_id: str) -> str:
+        """Answer one user turn in the given A2A context; raises on failure."""
+        # One turn per context at a time: a thread accepts no new message while
+        # a run is active, and concurrent first turns would each create a thread
+        lock = self._context_locks.get(context_id)
+        if lock is None:
+            lock = self._context_locks[context_id] = asyncio.Lock()
+        async with lock:
+            return await self._chat_turn(user_text, context_id)
+
+    async def _chat_turn(self, user_text: str, context_id: str) -> str:
+        thread_id = self.threads.get(context_id)
+        history = self.cached_turns.get(context_id, [])
+        first_turn = thread_id is None and not history
+
+        # === Repeat first-turn questions are answered from the in-process cache ===
+        cache_key = user_text.strip().lower()
+        if first_turn:
+            reply_text = self.replies.get(cache_key)
+            if reply_text is not None:
+                self.cached_turns[context_id] = [
+                    {"role": "user", "content": user_text},
+                    {"role": "assistant", "content": reply_text}
+                ]
+                return reply_text
+
+        if thread_id is not None:
+            try:
+                await self.post_message(thread_id, user_text)
+            except aiohttp.ClientResponseError as e:
+                if e.status != 404:
+                    raise
+                thread_id = None  # thread deleted on the Azure side → start over
+
+        if thread_id is None:
+            run, reply_text = await self.create_thread_and_run(user_text, history)
+        else:
+            run, reply_text = await self.run(thread_id)
+        if run is None:
+            raise RuntimeError("Run stream ended before the run was created")
+        self.threads[context_id] = run["thread_id"]
+        self.cached_turns.pop(context_id, None)
+
+        # Stream dropped mid-run → poll the run, then fetch the reply
+        if reply_text is None:
+            await self.wait_complete(run["thread_id"], run["id"])
+            reply_text = await self.latest_assistant_message(run["thread_id"])
+        reply_text = reply_text or "No reply"
+
+        if first_turn and reply_text != "No reply":
+            self.replies[cache_key] = reply_text
+        self._reap_threads()
+        return reply_text
+
+
+# One client (session, token, caches) per worker process
+CLIENT = AzureAIClient()
@@ -1,23 +1,31 @@
 # --------------------------------------------------------------
-#  function_app.py  (Azure Functions v2 – single file)
+#  function_app.py  (Azure Functions v2 – HTTP entrypoint)
 # --------------------------------------------------------------
 import uuid
+import hashlib
 import azure.functions as func
-import json
-import time
+import orjson
+import asyncio
 import logging
-from azure.identity import DefaultAzureCredential
-import requests
-import os
+import fastjsonschema
+from a2a_core import CLIENT
+
+logger = logging.getLogger(__name__)
 
 # ------------------------------------------------------------------
-# 1. Azure AI Studio configuration
+# 1. Response constants
 # ------------------------------------------------------------------
-PROJECT_NAME = "agent-to-agent-5055"
-AI_SERVICE_NAME = "agent-to-agent-5055-resource"
-ASSISTANT_ID = "asst_zQ8ANX9CJfElxVlHKEKiLa5P"
-API_VERSION = "2025-05-01"
-BASE_URL = f"https://{AI_SERVICE_NAME}.services.ai.azure.com/api/projects/{PROJECT_NAME}"
+# HttpResponse copies the headers it is given, so these can be shared
+_JSON_CT = "application/json"
+_CORS_HEADERS = {"Access-Control-Allow-Origin": "*"}
+# Browsers cache this preflight answer for Access-Control-Max-Age seconds
+_PREFLIGHT_HEADERS = {
+    **_CORS_HEADERS,
+    "Access-Control-Allow-Methods": "POST, GET, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type, Authorization",
+    "Access-Control-Max-Age": "86400",
+    "Vary": "Origin"
+}
 
 # ------------------------------------------------------------------
 # 2. Function App
@@ -27,6 +35,38 @@ app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 # ------------------------------------------------------------------
 # 3. GET  /api/chat/.well-known/agent-card.json  → A2A discovery
 # ------------------------------------------------------------------
+AGENT_CARD = {
+    "name": "Capital Agent",
+    "description": "Answers capital-city questions for any country",
+    "version": "1.0.0",
+    "url": "https://func-a2a5055-a6fufrexfuaed0f7.eastus2-01.azurewebsites.net/api/chat",
+    "preferredTransport": "JSONRPC",                 # <-- CRITICAL
+    "protocolVersion": "0.3.0",
+    "capabilities": {"streaming": True},
+    "defaultInputModes": ["text"],
+    "defaultOutputModes": ["text"],
+    "skills": [
+        {
+            "id": "capital_query",               # <-- REQUIRED
+            "name": "capital_query",
+            "description": "Answers capital-city questions",
+            "inputModes": ["text"],
+            "outputModes": ["text"],
+            "tags": ["capital", "country"]        # <-- REQUIRED
+        }
+    ]
+}
+
+# The card is static – serialize it once and serve the cached bytes.
+_CARD_BYTES = orjson.dumps(AGENT_CARD)
+_CARD_ETAG = f'"{hashlib.sha1(_CARD_BYTES).hexdigest()}"'
+_CARD_HEADERS = {
+    **_CORS_HEADERS,
+    "Cache-Control": "public, max-age=300",
+    "ETag": _CARD_ETAG
+}
+
+
 @app.route(route="chat/.well-known/agent-card.json", methods=["GET"])
 def get_agent_card(req: func.HttpRequest) -> func.HttpResponse:
     """
@@ -34,201 +74,186 @@ def get_agent_card(req: func.HttpRequest) -> func.HttpResponse:
       • id & tags in every skill
       • preferredTransport = "HTTP"   (not JSON-RPC)
     """
-    card = {
-        "name": "Capital Agent",
-        "description": "Answers capital-city questions for any country",
-        "version": "1.0.0",
-        "url": "https://func-a2a5055-a6fufrexfuaed0f7.eastus2-01.azurewebsites.net/api/chat",
-        "preferredTransport": "JSONRPC",                 # <-- CRITICAL
-        "protocolVersion": "0.3.0",
-        "capabilities": {"streaming": True},
-        "defaultInputModes": ["text"],
-        "defaultOutputModes": ["text"],
-        "skills": [
-            {
-                "id": "capital_query",               # <-- REQUIRED
-                "name": "capital_query",
-                "description": "Answers capital-city questions",
-                "inputModes": ["text"],
-                "outputModes": ["text"],
-                "tags": ["capital", "country"]        # <-- REQUIRED
-            }
-        ]
-    }
-
-    resp = func.HttpResponse(
-        json.dumps(card),
-        mimetype="application/json",
-        status_code=200
+    if req.headers.get("If-None-Match") == _CARD_ETAG:
+        return func.HttpResponse(status_code=304, headers=_CARD_HEADERS)
+    return func.HttpResponse(
+        _CARD_BYTES,
+        mimetype=_JSON_CT,
+        status_code=200,
+        headers=_CARD_HEADERS
     )
-    resp.headers["Access-Control-Allow-Origin"] = "*"
-    return resp
 
 
 # ------------------------------------------------------------------
-# 4. Helper – Azure AI token
+# 4. Helper – JSON-RPC responses
 # ------------------------------------------------------------------
-def get_token() -> str:
-    return DefaultAzureCredential().get_token("https://ai.azure.com").token
-
-
-def call_api(method: str, url: str, json_body: dict | None = None):
-    headers = {
-        "Authorization": f"Bearer {get_token()}",
-        "Content-Type": "application/json"
-    }
-    resp = requests.request(method, url, headers=headers, json=json_body)
-    resp.raise_for_status()
-    return resp.json()
-
-def _jsonrpc_error(code: int, message: str, request_id=None):
-    resp = {
+def _jsonrpc_error(code: int, message: str, request_id=None) -> dict:
+    return {
         "jsonrpc": "2.0",
         "error": {"code": code, "message": message},
         "id": request_id
     }
-    return func.HttpResponse(
-        json.dumps(resp),
-        mimetype="application/json",
-        status_code=200,
-        headers={"Access-Control-Allow-Origin": "*"}
-    )
 
-def _jsonrpc_success(result: dict, request_id):
-    resp = {
+# Shared, never mutated – only ever serialized
+_COMPLETED_STATUS = {"state": "completed"}
+
+def _jsonrpc_success(result: dict, request_id) -> dict:
+    return {
         "jsonrpc": "2.0",
         "result": result,
         "id": request_id
     }
+
+def _http_response(body: dict | list) -> func.HttpResponse:
     return func.HttpResponse(
-        json.dumps(resp),
-        mimetype="application/json",
+        orjson.dumps(body),
+        mimetype=_JSON_CT,
         status_code=200,
-        headers={"Access-Control-Allow-Origin": "*"}
+        headers=_CORS_HEADERS
     )
 #------------------------------------------------------------
 # 5. POST /api/chat  →  A2A SendMessageRequest (raw HTTP)
 # ------------------------------------------------------------------
+# Max batch elements processed concurrently (JSON-RPC batch requests)
+BATCH_MAX_CONCURRENCY = 32
+
+# Request validation – schemas are compiled to Python code once at import.
+# Envelope and params are checked separately so the JSON-RPC error code
+# (-32600 / -32601 / -32602) stays as specific as before.
+SUPPORTED_METHODS = ("sendMessage", "message/send")
+
+_validate_envelope = fastjsonschema.compile({
+    "type": "object",
+    "required": ["jsonrpc", "method", "id"],
+    "properties": {
+        "jsonrpc": {"const": "2.0"},
+        "method": {"type": "string"},
+        "id": {"type": ["string", "number", "null"]}
+    }
+})
+
+_validate_params = fastjsonschema.compile({
+    "type": "object",
+    "required": ["message"],
+    "properties": {
+        "message": {
+            "type": "object",
+            "required": ["parts"],
+            "properties": {
+                "contextId": {"type": ["string", "null"]},
+                "messageId": {"type": ["string", "null"]},
+                "parts": {
+                    "type": "array",
+                    "contains": {
+                        "type": "object",
+                        "required": ["kind", "text"],
+                        "properties": {
+                            "kind": {"const": "text"},
+                            "text": {"type": "string", "minLength": 1}
+                        }
+                    }
+                }
+            }
+        }
+    }
+})
+
+
+@app.route(route="chat", methods=["OPTIONS"], auth_level=func.AuthLevel.ANONYMOUS)
+def chat_preflight(req: func.HttpRequest) -> func.HttpResponse:
+    """CORS preflight for browser A2A clients – static, no body."""
+    return func.HttpResponse(status_code=204, headers=_PREFLIGHT_HEADERS)
+
+
 @app.route(route="chat", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)
 async def chat(req: func.HttpRequest) -> func.HttpResponse:
     try:
-        payload = req.get_json()
+        payload = orjson.loads(req.get_body())
     except Exception:
-        return _jsonrpc_error(-32700, "Parse error")
-
-    if not isinstance(payload, dict):
-        return _jsonrpc_error(-32600, "Invalid Request")
-    if payload.get("jsonrpc") != "2.0":
-        return _jsonrpc_error(-32600, "Invalid JSON-RPC version")
-    if "method" not in payload or "id" not in payload:
-        return _jsonrpc_error(-32600, "Missing method or id")
-   
-    method = payload["method"]
-    request_id = payload["id"]
-    params = payload.get("params", {})
+        return _http_response(_jsonrpc_error(-32700, "Parse error"))
 
-    # === SUPPORT message/send AND sendMessage ===
-    if method not in ["sendMessage", "message/send"]:
-        return _jsonrpc_error(-32601, f"Method not found: {method}", request_id)
+    if not isinstance(payload, list):
+        return _http_response(await handle_rpc(payload))
 
-    # === Extract text from parts SAFELY ===
-    message = params.get("message", {})
-    parts = message.get("parts", [])
-    user_text = ""
+    # === JSON-RPC batch: elements run concurrently, replies keep order ===
+    if not payload:
+        return _http_response(_jsonrpc_error(-32600, "Invalid Request"))
 
-    for part in parts:
-        if isinstance(part, dict) and part.get("kind") == "text" and "text" in part:
-            user_text = part["text"]
-            break
+    sem = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
 
-    # === RETURN USING kind ===
-   
+    async def bounded(element):
+        async with sem:
+            return await handle_rpc(element)
 
-    if not user_text:
-        print(f"DEBUG: Received payload: {json.dumps(payload, indent=2)}")
-        return _jsonrpc_error(-32602, "Invalid params: no valid text part", request_id)
+    return _http_response(list(await asyncio.gather(*(bounded(p) for p in payload))))
 
-    # === Call Azure AI Studio ===
+
+async def handle_rpc(payload) -> dict:
+    """Process one JSON-RPC request object and return its response object."""
     try:
-        thread = call_api("POST", f"{BASE_URL}/threads?api-version={API_VERSION}", {})
-        thread_id = thread["id"]
+        _validate_envelope(payload)
+    except fastjsonschema.JsonSchemaException as e:
+        # Echo the id only if it is itself valid (JSON-RPC: null otherwise)
+        request_id = payload.get("id") if isinstance(payload, dict) else None
+        if isinstance(request_id, bool) or not isinstance(request_id, (str, int, float)):
+            request_id = None
+        return _jsonrpc_error(-32600, f"Invalid Request: {e.message}", request_id)
 
-        call_api("POST", f"{BASE_URL}/threads/{thread_id}/messages?api-version={API_VERSION}",
-                 {"role": "user", "content": user_text})
+    method = payload["method"]
+    request_id = payload["id"]
+    params = payload.get("params", {})
 
-        run = call_api("POST", f"{BASE_URL}/threads/{thread_id}/runs?api-version={API_VERSION}",
-                       {"assistant_id": ASSISTANT_ID})
-        run_id = run["id"]
+    # === SUPPORT message/send AND sendMessage ===
+    if method not in SUPPORTED_METHODS:
+        return _jsonrpc_error(-32601, f"Method not found: {method}", request_id)
+
+    # === Schema guarantees at least one non-empty text part ===
+    try:
+        _validate_params(params)
+    except fastjsonschema.JsonSchemaException as e:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received payload: %s", orjson.dumps(payload).decode())
+        return _jsonrpc_error(-32602, f"Invalid params: {e.message}", request_id)
 
-        while True:
-            status_resp = call_api("GET", f"{BASE_URL}/threads/{thread_id}/runs/{run_id}?api-version={API_VERSION}")
-            status = status_resp["status"]
-            if status == "completed": break
-            if status in ["failed", "cancelled"]:
-                raise RuntimeError(f"Run {status}")
-            time.sleep(1.5)
+    message = params["message"]
+    user_text = next(part["text"] for part in message["parts"]
+                     if isinstance(part, dict) and part.get("kind") == "text"
+                     and isinstance(part.get("text"), str) and part["text"])
 
-        messages = call_api("GET", f"{BASE_URL}/threads/{thread_id}/messages?api-version={API_VERSION}")
-        reply_msg = next((m for m in messages["data"] if m["role"] == "assistant"), None)
-        reply_text = reply_msg["content"][0]["text"]["value"] if reply_msg else "No reply"
+    context_id = message.get("contextId") or str(uuid.uuid4())
 
+    # === Call Azure AI Studio ===
+    try:
+        reply_text = await CLIENT.chat(user_text, context_id)
     except Exception as e:
-        logging.exception("AI call failed")
+        logger.exception("AI call failed")
         return _jsonrpc_error(-32000, str(e), request_id)
 
     # === Return Success ===
     # === RETURN ADK NATIVE FORMAT (MATCH LOCAL AGENT) ===
     task_id = str(uuid.uuid4())  # Generate task ID
+    # Read-only until serialized, so artifact and history share one parts list
+    reply_parts = [{"kind": "text", "text": reply_text}]
 
     a2a_result = {
         "kind": "task",
         "id": task_id,  # REQUIRED BY ADK
-        "status": {"state": "completed"},
+        "status": _COMPLETED_STATUS,
         "artifacts": [
             {
                 "artifactId": str(uuid.uuid4()),
-                "parts": [
-                    {"kind": "text", "text": reply_text}
-                ]
+                "parts": reply_parts
             }
         ],
-        "contextId": message.get("contextId", "unknown"),
+        "contextId": context_id,
         "history": [
             {
                 "kind": "message",
                 "messageId": message.get("messageId", "unknown"),
                 "role": "agent",  # "assistant" → "agent" (ADK SPEC)
-                "parts": [{"kind": "text", "text": reply_text}],
-                "contextId": message.get("contextId", "unknown")
+                "parts": reply_parts,
+                "contextId": context_id
             }
         ]
     }
-    return _jsonrpc_success(a2a_result, request_id)
-    # task_id = str(uuid.uuid4())
-    # message_id = str(uuid.uuid4())
-    # context_id = message.get("contextId") or str(uuid.uuid4())
-
-    # task = {
-    #     "kind": "task",
-    #     "id": task_id,
-    #     "contextId": context_id,
-    #     "status": "completed",
-    #     "messages": [
-    #         {
-    #             "role": "assistant",
-    #             "parts": [{"kind": "text", "text": reply_text}],
-    #             "messageId": message_id
-    #         }
-    #     ]
-    # }
-
-    # response = {
-    #     "jsonrpc": "2.0",
-    #     "result": task,
-    #     "id": request_id
-    # }
-
-    # return _jsonrpc_success(
-    #     content=response,
-    #     headers={"Access-Control-Allow-Origin": "*"}
-    # )
\ No newline at end of file
+    return _jsonrpc_success(a2a_result, request_id)
\ No newline at end of file
@@ -1,12 +1,18 @@
 import azure.functions as func
-import json
+import hashlib
+import orjson
 import os
 
+# Load your agent card once at import (place it in the project root)
+card_path = os.path.join(os.path.dirname(__file__), '..', 'agent_card.json')
+with open(card_path, 'rb') as f:
+    _CARD_BYTES = orjson.dumps(orjson.loads(f.read()))
+_CARD_ETAG = f'"{hashlib.sha1(_CARD_BYTES).hexdigest()}"'
+_CARD_HEADERS = {'Cache-Control': 'public, max-age=300', 'ETag': _CARD_ETAG}
+
 def main(req: func.HttpRequest) -> func.HttpResponse:
     if req.method == 'GET' and '/.well-known/agent-card.json' in req.url:
-        # Load your agent-card.json (place it in the project root or as a string)
-        card_path = os.path.join(os.path.dirname(__file__), '..', 'agent-card.json')
-        with open(card_path, 'r') as f:
-            card = json.load(f)
-        return func.HttpResponse(json.dumps(card), mimetype='application/json', status_code=200)
+        if req.headers.get('If-None-Match') == _CARD_ETAG:
+            return func.HttpResponse(status_code=304, headers=_CARD_HEADERS)
+        return func.HttpResponse(_CARD_BYTES, mimetype='application/json', status_code=200, headers=_CARD_HEADERS)
     return func.HttpResponse("Not Found", status_code=404)
\ No newline at end of file